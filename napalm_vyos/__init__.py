@@ -13,4 +13,4 @@
 # the License.
 
 """napalm_vyos package."""
-from vyos import VyOSDriver
+from napalm_vyos.vyos import VyOSDriver
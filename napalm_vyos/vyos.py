@@ -18,7 +18,18 @@ Napalm driver for VyOS.
 Read napalm.readthedocs.org for more information.
 """
 
+import atexit
+import codecs
+import hashlib
+import itertools
+import os
 import re
+import shlex
+import socket
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 # third party libs
 import paramiko
@@ -31,14 +42,118 @@ from napalm_base.exceptions import ConnectionException, SessionLockedException,
                                    CommandErrorException
 
 
+# Printed by the persistent shell after every command: "__END_<marker id>__<exit status>__"
+_END_MARKER_RE = re.compile(r"__END_(\d+)__(\d+)__\n")
+_MARKER_IDS = itertools.count(1)
+# Printed between the outputs of the commands sent by _send_commands_batch
+_SEP_MARKER_RE = re.compile(r"__SEP_\d+__\n")
+
+# Patterns used by the parsers, compiled once at import time
+_RE_IFACE_STATE = re.compile(r"(\S+)\s+[:\-\d/\.]+\s+([uAD])/([uAD])")
+# interface header line, then indented or empty lines up to the RX and TX counter rows.
+# The two kinds of skipped lines must not overlap, else a block without counters backtracks exponentially.
+_RE_IFACE_DETAIL = re.compile(r"^(\S+): <.*\n(?:[ \t][^\n]*\n|\n)*?"
+                              r"[ \t]+RX:.*\n\s*(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+\d+\s+(\d+).*\n"
+                              r"[ \t]+TX:.*\n\s*(\d+)\s+(\d+)\s+(\d+)\s+(\d+)", re.M)
+# "show interfaces" row with an address, the interface name is empty on continuation rows
+_RE_IFACE_IP = re.compile(r"^(\S+)?[ \t]+([0-9a-fA-F:.]+)/(\d+)", re.M)
+_RE_IPV4 = re.compile(r"(\d+\.\d+\.\d+\.\d+)")
+_RE_RTR_ID = re.compile(r".* router identifier (\d+\.\d+\.\d+\.\d+), local AS number (\d+)")
+_RE_REMOTE_RID = re.compile(r"remote router ID (\d+\.\d+\.\d+\.\d+)")
+_RE_ACCEPTED = re.compile(r"(\d+) accepted prefixes")
+_RE_BGP_NEIGHBOR = re.compile(r"^BGP neighbor is (\S+),", re.M)
+_RE_BGP_UPTIME = re.compile(r"(\d+)([ywdhms])")
+_RE_PING_RTT = re.compile(r"([\d\.]+)/([\d\.]+)/([\d\.]+)/[\d\.]+")
+# a "show configuration" line: name, optional value (or tag) and optional opening brace
+_RE_CONFIG_LINE = re.compile(r"^(\S+)(?:\s+(.*?))?\s*(\{)?$")
+
+
+# Connections released by close() are kept here and reused by the next open() for the same
+# (hostname, port, username, password), so that polling loops do not pay an SSH handshake each time.
+# Disabled by default, as close() then leaves the SSH session open on the device.
+CONNECTION_POOL_ENABLED = os.environ.get("CONNECTION_POOL_ENABLED", "0").lower() in ("1", "true", "yes")
+CONNECTION_POOL_MAX_SIZE = int(os.environ.get("CONNECTION_POOL_MAX_SIZE", 16))
+CONNECTION_POOL_IDLE_TIMEOUT = int(os.environ.get("CONNECTION_POOL_IDLE_TIMEOUT", 300))
+CONNECTION_POOL_MAX_AGE = int(os.environ.get("CONNECTION_POOL_MAX_AGE", 3600))
+
+# (hostname, port, username, password digest) -> (SSHClient, shell channel, connected at, last used)
+_POOL = {}
+_POOL_LOCK = threading.Lock()
+
+
+def _pool_get(key):
+  """Take a live connection out of the pool, return (SSHClient, shell channel, connected at) or None."""
+  now = time.monotonic()
+  expired = list()
+
+  with _POOL_LOCK:
+    for k, (client, shell, connected_at, last_used) in list(_POOL.items()):
+      if now - last_used > CONNECTION_POOL_IDLE_TIMEOUT or now - connected_at > CONNECTION_POOL_MAX_AGE:
+        expired.append(client)
+        del _POOL[k]
+    entry = _POOL.pop(key, None)
+
+  for client in expired:
+    client.close()
+
+  if entry is None:
+    return None
+
+  client, shell, connected_at, last_used = entry
+  transport = client.get_transport()
+  if transport is None or not transport.is_active() or shell.closed:
+    client.close()
+    return None
+
+  return client, shell, connected_at
+
+
+def _pool_clear():
+  """Close all pooled connections, registered to run at interpreter exit."""
+  with _POOL_LOCK:
+    entries = list(_POOL.values())
+    _POOL.clear()
+
+  for client, shell, connected_at, last_used in entries:
+    client.close()
+
+
+atexit.register(_pool_clear)
+
+
+def _pool_put(key, client, shell, connected_at):
+  """Return a connection to the pool, return False if the pool has no room for it."""
+  with _POOL_LOCK:
+    if key in _POOL or len(_POOL) >= CONNECTION_POOL_MAX_SIZE:
+      return False
+    _POOL[key] = (client, shell, connected_at, time.monotonic())
+  return True
+
+
+def _match_path(path, pattern):
+  """Compare a config path with a pattern ("*" matches any name) over their common length."""
+  return all(p == "*" or p == x for x, p in zip(path, pattern))
+
+
 class VyOSDriver(NetworkDriver):
 
-  _CMD_PREFIX = ". /etc/bash_completion; eval _vyatta_op_run "
+  _CMD_SETUP  = ". /etc/bash_completion"
+  _CMD_OP     = "eval _vyatta_op_run "
+  _CMD_PREFIX = _CMD_SETUP + "; " + _CMD_OP
   _MINUTE_SECONDS = 60 
   _HOUR_SECONDS =  60 * _MINUTE_SECONDS
   _DAY_SECONDS  =  24 * _HOUR_SECONDS
   _WEEK_SECONDS =   7 * _DAY_SECONDS
   _YEAR_SECONDS = 365 * _DAY_SECONDS
+  # units of the BGP Up/Down column, e.g. "4d23h40m" or "1y2w3d"
+  _BGP_TIMES = {
+    "y": _YEAR_SECONDS,
+    "w": _WEEK_SECONDS,
+    "d": _DAY_SECONDS,
+    "h": _HOUR_SECONDS,
+    "m": _MINUTE_SECONDS,
+    "s": 1
+  }
 
   def __init__(self, hostname, username, password, timeout=60, optional_args=None):
     self._hostname = hostname
@@ -46,22 +161,80 @@ class VyOSDriver(NetworkDriver):
     self._password = password
     self._timeout  = timeout    
     self._device  = None
-    if optional_args and optional_args.has_key('port'):
-        self._port = optional_args['port']
-    else:
-        self._port = 22
+    self._shell   = None
+    # id of the end marker of a command whose output has not been read completely yet
+    self._pending_marker = None
+    self._connected_at = None
+    if optional_args is None:
+      optional_args = dict()
+    self._port = optional_args.get('port', 22)
+    # Run the commands of _send_commands_batch concurrently on their own channels
+    # instead of sending them together over the shell
+    self._parallel_commands = bool(optional_args.get('parallel_commands', False))
+    self._thread_pool = None
     self._new_config = None
     self._old_config = None
+    # (text, parsed or None) of the last "show configuration", see _get_config_text()
+    self._config_cache = (None, None)
+    self._config_cache_time = 0
+    self._config_cache_ttl = 5
 
 
   def open(self):
+    if CONNECTION_POOL_ENABLED:
+      pooled = _pool_get(self._pool_key())
+      if pooled is not None:
+        self._device, self._shell, self._connected_at = pooled
+        self._shell.settimeout(self._timeout)
+        return
+
     self._device = paramiko.SSHClient()
     self._device.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    self._device.connect(self._hostname, self._port, self._username, self._password)
+    # Only password authentication is used, so skip the agent/key file lookups
+    # which can stall the login. Compression does not pay off for short command outputs.
+    self._device.connect(self._hostname, self._port, self._username, self._password,
+                         allow_agent=False, look_for_keys=False, compress=False)
+
+    # Commands and their outputs are small, so send them without waiting for Nagle's
+    # algorithm, and keep the idle session alive between getter calls
+    transport = self._device.get_transport()
+    transport.set_keepalive(30)
+    transport.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    # A single long-lived shell channel is used for all commands, so that
+    # each command costs one round trip instead of a new channel open + exec.
+    # No pty is requested: the shell then neither echoes input nor prints prompts.
+    self._shell = transport.open_session()
+    self._shell.settimeout(self._timeout)
+    self._shell.invoke_shell()
+    # stderr is not read from the shell channel, so discard it on the device.
+    # The bash completion which defines _vyatta_op_run is sourced once for the whole session.
+    self._send_command("exec 2>/dev/null\n" + self._CMD_SETUP, is_vyatta_op=False)
+    self._connected_at = time.monotonic()
 
 
   def close(self):
-    self._device.close()
+    if self._thread_pool is not None:
+      self._thread_pool.shutdown()
+      self._thread_pool = None
+
+    # only a shell whose last command has been read up to its end marker can be reused
+    if CONNECTION_POOL_ENABLED and self._shell is not None and self._pending_marker is None:
+      if _pool_put(self._pool_key(), self._device, self._shell, self._connected_at):
+        self._shell = None
+        self._device = None
+        return
+
+    self._reset_shell()
+    if self._device is not None:
+      self._device.close()
+      self._device = None
+
+
+  def _pool_key(self):
+    # A session is only reused with the password it was authenticated with
+    password = hashlib.sha256((self._password or "").encode("utf-8")).hexdigest()
+    return (self._hostname, self._port, self._username, password)
 
 
   def load_merge_candidate(self, filename=None, config=None):
@@ -91,17 +264,16 @@ class VyOSDriver(NetworkDriver):
       /opt/vyatta/sbin/vyatta-cfg-cmd-wrapper end;
     """
     cfg_cmd_wrapper = "/opt/vyatta/sbin/vyatta-cfg-cmd-wrapper "
-    # delete empty element
-    cfg = [x for x in self._new_config.split("\n") if x is not ""]
-    
-    # arrangemenet config commands 
-    cfg_cmd = [cfg_cmd_wrapper + x + ";" for x in cfg]
-    cfg_cmd = cfg_cmd_wrapper + "begin;" \
-            + ''.join(cfg_cmd) \
-            + cfg_cmd_wrapper + "commit;" \
-            + cfg_cmd_wrapper + "end;"
+
+    # arrangemenet config commands, skipping empty lines
+    cfg_cmd = [cfg_cmd_wrapper + "begin;"]
+    cfg_cmd.extend(cfg_cmd_wrapper + x + ";" for x in self._new_config.splitlines() if x)
+    cfg_cmd.append(cfg_cmd_wrapper + "commit;")
+    cfg_cmd.append(cfg_cmd_wrapper + "end;")
+    cfg_cmd = "".join(cfg_cmd)
 
     self._send_command(cfg_cmd)
+    self._config_cache = (None, None)
 
 
   def get_environment(self):
@@ -113,8 +285,9 @@ class VyOSDriver(NetworkDriver):
     r  b   swpd   free   buff  cache   si   so    bi    bo   in   cs us sy id wa
     0  0      0  61404 139624 139360    0    0     0     0    9   14  0  0 100  0
     """
-    output_cpu = self._send_command("vmstat", is_vyatta_op=False).split("\n")[-2]
-    cpu = 100 - int(output_cpu.split()[-2])
+    output_cpu = self._send_command("vmstat", is_vyatta_op=False).rsplit("\n", 2)[-2]
+    # the 15th column is "id" (idle), only split up to there
+    cpu = 100 - int(output_cpu.split(None, 15)[14])
 
     """
     'free' output:
@@ -123,8 +296,8 @@ class VyOSDriver(NetworkDriver):
     -/+ buffers/cache:     167800     340356
     Swap:            0          0          0
     """
-    output_ram = self._send_command("free", is_vyatta_op=False).split("\n")[1]
-    available_ram, used_ram = output_ram.split()[1:3]
+    output_ram = self._send_command("free", is_vyatta_op=False).split("\n", 2)[1]
+    available_ram, used_ram = output_ram.split(None, 3)[1:3]
 
     environment = {
       "fans": {
@@ -167,45 +340,47 @@ class VyOSDriver(NetworkDriver):
     lo               127.0.0.1/8                       u/u
                      ::1/128
     """
-    output_iface = self._send_command("show interfaces")
+    output_iface, output_conf = self._send_commands_batch(["show interfaces", "show configuration"])
 
     # Collect all interfaces' name and status
-    match = re.findall("(\S+)\s+[:\-\d/\.]+\s+([uAD])/([uAD])", output_iface)
+    match = _RE_IFACE_STATE.findall(output_iface)
 
     # 'match' example:
     # [("br0", "u", "D"), ("eth0", "u", "u"), ("eth1", "u", "u")...]
     iface_state = {iface_name:{"State": state, "Link": link} for iface_name, state, link in match}
 
-    output_conf = self._send_command("show configuration")
+    # Collect the settings of each interface,
+    # e.g. {"eth0": {"description": "Management", "hw-id": "00:50:56:86:8c:26"}, "lo": {}}
+    ifaces_detail = dict()
+    config = self._get_config_text(output_conf)
 
-    # Convert the configuration to dictionary 
-    config = vyattaconfparser.parse_conf(output_conf)
+    for path, value in self._config_get(config, ("interfaces", "*", "*")):
+      if len(path) == 3 and value is None:
+        ifaces_detail[path[2]] = dict()
+      elif len(path) == 4 and value is not None:
+        ifaces_detail[path[2]][path[3]] = value
 
     iface_dict = dict()
 
-    for iface_type in config["interfaces"]: 
+    for iface_name in ifaces_detail:
 
-      ifaces_detail = config["interfaces"][iface_type]
+      description = self._get_value("description", ifaces_detail[iface_name])
+      speed = self._get_value("speed", ifaces_detail[iface_name])
+      hw_id = self._get_value("hw-id", ifaces_detail[iface_name])
 
-      for iface_name in ifaces_detail:
+      is_up      = (iface_state[iface_name]["Link"]  == "u")
+      is_enabled = (iface_state[iface_name]["State"] == "u")
 
-        description = self._get_value("description", ifaces_detail[iface_name])
-        speed = self._get_value("speed", ifaces_detail[iface_name])
-        hw_id = self._get_value("hw-id", ifaces_detail[iface_name])
-
-        is_up      = (iface_state[iface_name]["Link"]  == "u")
-        is_enabled = (iface_state[iface_name]["State"] == "u")
-
-        iface_dict.update({
-          iface_name: {
-            "is_up"        : is_up,
-            "is_enabled"   : is_enabled,
-            "description"  : description,
-            "last_flapped" : -1,
-            "speed"        : speed,
-            "mac_address"  : hw_id 
-          }
-        })
+      iface_dict.update({
+        iface_name: {
+          "is_up"        : is_up,
+          "is_enabled"   : is_enabled,
+          "description"  : description,
+          "last_flapped" : -1,
+          "speed"        : speed,
+          "mac_address"  : hw_id 
+        }
+      })
 
     return iface_dict
 
@@ -231,26 +406,13 @@ class VyOSDriver(NetworkDriver):
     10.129.2.97              ether   00:50:56:9f:64:09   C                     eth0
     192.168.1.3              ether   00:50:56:86:7b:06   C                     eth1
     """
-    output = self._send_command("show arp")
-    output = output.split("\n")
+    output = self._send_command("show arp").splitlines()
 
-    # Skip the header line
-    output = output[1:-1]
-
-    arp_table = list() 
-
-    for line in output:
-
-      line = line.split()
-
-      # 'line' example:
-      # ["10.129.2.254", "ether", "00:50:56:97:af:b1", "C", "eth0"]
-      arp_table.append({
-        "interface" : unicode(line[4]),
-        "mac" : unicode(line[2]),
-        "ip"  : unicode(line[0]),
-        "age" : None
-      })
+    # Skip the header line, and the incomplete entries which have no HWaddress
+    # 'line' example:
+    # ["10.129.2.254", "ether", "00:50:56:97:af:b1", "C", "eth0"]
+    arp_table = [{"interface": line[4], "mac": line[2], "ip": line[0], "age": None}
+                 for line in (x.split() for x in output[1:]) if len(line) >= 5]
 
     return arp_table
 
@@ -265,7 +427,7 @@ class VyOSDriver(NetworkDriver):
      133.130.120.204 133.243.238.164  2 u   46   64  377    7.717  987996. 1669.77
     """
 
-    output = self._send_command("ntpq -np", is_vyatta_op=False).split("\n")[2:-1]
+    output = self._send_command("ntpq -np", is_vyatta_op=False).splitlines()[2:]
 
     ntp_stats = list()
 
@@ -275,15 +437,15 @@ class VyOSDriver(NetworkDriver):
       # 'remote' contains '*' if the machine synchronized with NTP server
       synchronized = "*" in remote
 
-      match = re.search("(\d+\.\d+\.\d+\.\d+)", remote)
+      match = _RE_IPV4.search(remote)
       ip = match.group(1)
 
       ntp_stats.append({
-        "remote"      : unicode(ip),
-        "referenceid" : unicode(refid),
+        "remote"      : str(ip),
+        "referenceid" : str(refid),
         "synchronized": synchronized,
         "stratum"     : int(st),
-        "type"        : unicode(t),
+        "type"        : str(t),
         "when"        : int(when),
         "hostpoll"    : int(hostpoll),
         "reachability": int(reachability),
@@ -296,14 +458,14 @@ class VyOSDriver(NetworkDriver):
 
   
   def get_ntp_peers(self):
-    output = self._send_command("ntpq -np", is_vyatta_op=False).split("\n")[2:-1]
+    output = self._send_command("ntpq -np", is_vyatta_op=False).splitlines()[2:]
 
     ntp_peers = dict()
   
     for line in output:
-      match = re.search("(\d+\.\d+\.\d+\.\d+)\s+", line)
+      match = _RE_IPV4.search(line)
       ntp_peers.update({
-        unicode(match.group(1)): {} 
+        str(match.group(1)): {} 
       })
 
     return ntp_peers
@@ -324,10 +486,29 @@ class VyOSDriver(NetworkDriver):
     192.168.1.4     4 64522       0       0        0    0    0 never    Active
     """
 
-    output = self._send_command("show ip bgp summary").split("\n")
+    """
+    'show ip bgp neighbors' output example:
+    BGP neighbor is 192.168.1.1, remote AS 64519, local AS 64520, external link
+    BGP version 4, remote router ID 192.168.1.1
+    For address family: IPv4 Unicast
+    ~~~
+    Community attribute sent to this neighbor(both)
+    1 accepted prefixes
+    ~~~
+    BGP neighbor is 192.168.1.3, remote AS 64521, local AS 64520, external link
+    ~~~
+    """
+
+    # Fetch the details of all peers together with the summary, instead of one command per peer
+    output, output_detail = self._send_commands_batch(["show ip bgp summary", "show ip bgp neighbors"])
+    output = output.splitlines()
+
+    # Split the details per peer: ["", "192.168.1.1", "<detail>", "192.168.1.3", "<detail>", ...]
+    output_detail = _RE_BGP_NEIGHBOR.split(output_detail)
+    bgp_details = dict(zip(output_detail[1::2], output_detail[2::2]))
 
-    match = re.search(".* router identifier (\d+\.\d+\.\d+\.\d+), local AS number (\d+)", output[0])
-    router_id = unicode(match.group(1))
+    match = _RE_RTR_ID.search(output[0])
+    router_id = str(match.group(1))
     local_as = int(match.group(2)) 
 
     bgp_neighbor_data = dict()
@@ -336,7 +517,7 @@ class VyOSDriver(NetworkDriver):
     bgp_neighbor_data["global"]["peers"] = {}
 
     # delete the header and empty element
-    bgp_info = [i.strip() for i in output[6:-3] if i is not ""]
+    bgp_info = [i.strip() for i in output[6:-2] if i]
 
     for i in bgp_info:
       peer_id , bgp_version, remote_as, msg_rcvd, msg_sent, table_version, \
@@ -356,23 +537,13 @@ class VyOSDriver(NetworkDriver):
         address_family = "ipv6"
       else:
         raise ValueError("BGP neighbor parsing failed")
-  
-      """
-      'show ip bgp neighbors 192.168.1.1' output example:
-      BGP neighbor is 192.168.1.1, remote AS 64519, local AS 64520, external link
-      BGP version 4, remote router ID 192.168.1.1
-      For address family: IPv4 Unicast
-      ~~~
-      Community attribute sent to this neighbor(both)
-      1 accepted prefixes
-      ~~~
-      """
-      bgp_detail = self._send_command("show ip bgp neighbors %s" % peer_id)
-
-      match_rid = re.search("remote router ID (\d+\.\d+\.\d+\.\d+).*", bgp_detail)
+
+      bgp_detail = bgp_details[peer_id]
+
+      match_rid = _RE_REMOTE_RID.search(bgp_detail)
       remote_rid = match_rid.group(1)
 
-      match_prefix_accepted = re.search("(\d+) accepted prefixes", bgp_detail)
+      match_prefix_accepted = _RE_ACCEPTED.search(bgp_detail)
       accepted_prefixes = match_prefix_accepted.group(1)
 
       bgp_neighbor_data["global"]["peers"].setdefault(peer_id, {})
@@ -381,7 +552,7 @@ class VyOSDriver(NetworkDriver):
         "is_enabled" : is_enabled,
         "local_as"   : local_as,
         "is_up"      : is_up,
-        "remote_id"  : unicode(remote_rid),
+        "remote_id"  : str(remote_rid),
         "uptime"     : self._bgp_time_conversion(up_time),
         "remote_as"  : int(remote_as)
       }
@@ -399,27 +570,19 @@ class VyOSDriver(NetworkDriver):
     return bgp_neighbor_data
 
 
-  def _bgp_time_conversion(self, bgp_uptime):
-    uptime_letters = set(["y", "w", "h", "d"])
-
+  @classmethod
+  def _bgp_time_conversion(cls, bgp_uptime):
     if "never" in bgp_uptime:
       return -1
     elif ":" in bgp_uptime:
       hours, minutes, seconds = map(int, bgp_uptime.split(":"))
-      return (hours * self._HOUR_SECONDS) + (minutes * self._MINUTE_SECONDS) + seconds
-    elif uptime_letters & set(bgp_uptime):
-      times = { 
-        "y": self._YEAR_SECONDS, 
-        "w": self._WEEK_SECONDS, 
-        "d": self._DAY_SECONDS,
-        "h": self._HOUR_SECONDS 
-      }
-      match = re.search("(\d+)(\w)(\d+)(\w)(\d+)(\w)", bgp_uptime)
-      uptime = int(match.group(1)) * times[match.group(2)] \
-             + int(match.group(3)) * times[match.group(4)] \
-             + int(match.group(5)) * times[match.group(6)]
-    
-    return uptime
+      return (hours * cls._HOUR_SECONDS) + (minutes * cls._MINUTE_SECONDS) + seconds
+
+    match = _RE_BGP_UPTIME.findall(bgp_uptime)
+    if not match:
+      raise ValueError("BGP uptime parsing failed: '%s'" % bgp_uptime)
+
+    return sum(int(n) * cls._BGP_TIMES[unit] for n, unit in match)
 
 
   def get_interfaces_counters(self):
@@ -436,41 +599,34 @@ class VyOSDriver(NetworkDriver):
     TX:  bytes    packets     errors    dropped    carrier collisions
       32776498     279273          0          0          0          0
     """
-    output = self._send_command("show interfaces detail")
-
-    interfaces =  re.findall("(\S+): <.*", output)
-    count = re.findall("(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+", output)
+    output = self._send_command_lines("show interfaces detail")
 
     counters = dict()
-    
-    j = 0 
-
-    for i in count:
-      if j % 2 == 0:
-        rx_errors = i[2]
-        rx_discards = i[3]
-        rx_octets = i[0]
-        rx_unicast_packets = None
-        rx_multicast_packets = i[5]
-        rx_broadcast_packets = None
-      else:
-        counters.update({
-          interfaces[j / 2]: {
-            "tx_errors"           : i[2],
-            "tx_discards"         : i[3],
-            "tx_octets"           : i[0],
-            "tx_unicast_packets"  : None,
-            "tx_multicast_packets": None,
-            "tx_broadcast_packets": None,
-            "rx_errors"           : rx_errors,
-            "rx_discards"         : rx_discards,
-            "rx_octets"           : rx_octets,
-            "rx_unicast_packets"  : rx_unicast_packets,
-            "rx_multicast_packets": rx_multicast_packets,
-            "rx_broadcast_packets": rx_broadcast_packets
-          }
-        })
-      j += 1
+
+    # Each interface is parsed as soon as its part of the output has been received
+    for iface_detail in self._split_blocks(output):
+      match = _RE_IFACE_DETAIL.match(iface_detail)
+      if match is None:
+        continue
+
+      iface_name = match.group(1)
+      rx_octets, rx_packets, rx_errors, rx_discards, rx_multicast_packets, \
+      tx_octets, tx_packets, tx_errors, tx_discards = map(int, match.groups()[1:])
+
+      counters[iface_name] = {
+        "tx_errors"           : tx_errors,
+        "tx_discards"         : tx_discards,
+        "tx_octets"           : tx_octets,
+        "tx_unicast_packets"  : None,
+        "tx_multicast_packets": None,
+        "tx_broadcast_packets": None,
+        "rx_errors"           : rx_errors,
+        "rx_discards"         : rx_discards,
+        "rx_octets"           : rx_octets,
+        "rx_unicast_packets"  : None,
+        "rx_multicast_packets": rx_multicast_packets,
+        "rx_broadcast_packets": None
+      }
 
     return counters
 
@@ -478,9 +634,8 @@ class VyOSDriver(NetworkDriver):
   def get_snmp_information(self):
     # 'acl' is not implemented yet
 
-    output = self._send_command("show configuration")
     # convert the configuration to dictionary 
-    config = vyattaconfparser.parse_conf(output)
+    config = self._get_config()
     
     snmp = dict()
     snmp["community"] = dict()
@@ -502,7 +657,8 @@ class VyOSDriver(NetworkDriver):
 
 
   def get_facts(self):
-    output = self._send_command("show version").split("\n")
+    output_ver, output_conf = self._send_commands_batch(["show version", "show configuration"])
+    output = output_ver.splitlines()
   
     uptime_str = [line for line in output if "Uptime" in line][0]
     uptime = self.parse_uptime(uptime_str)
@@ -513,45 +669,296 @@ class VyOSDriver(NetworkDriver):
     sn_str = [line for line in output if "S/N" in line][0]
     snumber = self.parse_snumber(sn_str)
 
-    output = self._send_command("show configuration")
-    config = vyattaconfparser.parse_conf(output)
-
-    hostname = config["system"]["host-name"]
-
-    fqdn = config["system"]["domain-name"]    
+    config = self._get_config_text(output_conf)
 
+    hostname = ""
+    fqdn = ""
     iface_list = list()
-    for iface_type in config["interfaces"]:
-      for iface_name in config["interfaces"][iface_type]:
-        iface_list.append(iface_name) 
+
+    paths = [("system", "host-name"), ("system", "domain-name"), ("interfaces", "*", "*")]
+    for path, value in self._config_get(config, *paths):
+      if path == ("system", "host-name"):
+        hostname = value
+      elif path == ("system", "domain-name"):
+        fqdn = value
+      elif len(path) == 3 and value is None:
+        iface_list.append(path[2])
 
     facts = {
       "uptime"        : int(uptime),
       "vendor"        : "VyOS",
-      "os_version"    : unicode(version),
-      "serial_number" : unicode(snumber),
+      "os_version"    : str(version),
+      "serial_number" : str(snumber),
       "model"         : "VyOS",
-      "hostname"      : unicode(hostname),
-      "fqdn"          : unicode(fqdn),
+      "hostname"      : str(hostname),
+      "fqdn"          : str(fqdn),
       "interface_list": iface_list
     }
 
     return facts
 
 
+  def _get_config_text(self, output=None):
+    """
+    Return the "show configuration" output, and keep it in the cache.
+    If 'output' is not given, the configuration is only fetched when the cached one is
+    older than _config_cache_ttl seconds.
+    """
+    now = time.monotonic()
+    text, config = self._config_cache
+
+    if output is None:
+      if text is not None and now - self._config_cache_time < self._config_cache_ttl:
+        return text
+      output = self._send_command("show configuration")
+
+    if output != text:
+      self._config_cache = (output, None)
+    self._config_cache_time = now
+
+    return output
+
+
+  def _get_config(self, output=None):
+    """
+    Return the whole configuration parsed by vyattaconfparser.
+    The configuration is only parsed again when its text has changed, see _get_config_text().
+    """
+    text = self._get_config_text(output)
+    config = self._config_cache[1]
+
+    if config is None:
+      config = vyattaconfparser.parse_conf(text)
+      self._config_cache = (text, config)
+
+    return config
+
+
+  @staticmethod
+  def _config_get(config, *paths):
+    """
+    Yield (path, value) for the nodes and leaves of 'config' ("show configuration" output)
+    which are under one of 'paths'. A path is a tuple of names, "*" matches any name,
+    e.g. ("interfaces", "*", "*") for ("interfaces", "ethernet", "eth0") and its contents.
+    Nodes are yielded with the value None, leaves with their value without quotes.
+
+    Unlike vyattaconfparser, the configuration is scanned line by line without building
+    the whole tree, and the parts which are not requested are skipped.
+    """
+    stack = list()  # path of the current node
+    pushed = list() # number of names pushed onto 'stack' by each open node
+    skip = 0        # depth inside a node which is not requested
+
+    for line in config.splitlines():
+      line = line.strip()
+
+      if skip:
+        if line.endswith("{"):
+          skip += 1
+        elif line == "}":
+          skip -= 1
+        continue
+
+      if not line or line.startswith("/*"):
+        continue
+
+      if line == "}":
+        del stack[len(stack) - pushed.pop():]
+        continue
+
+      name, value, brace = _RE_CONFIG_LINE.match(line).groups()
+
+      if brace:
+        # "system {" or "ethernet eth0 {"
+        names = (name, value) if value else (name,)
+        path = tuple(stack) + names
+        if not any(_match_path(path, x) for x in paths):
+          skip = 1
+          continue
+        stack.extend(names)
+        pushed.append(len(names))
+        value = None
+      else:
+        # "host-name vyos" or "description \"foo bar\""
+        path = tuple(stack) + (name,)
+        if value is not None:
+          value = value.strip('"')
+
+      if any(len(path) >= len(x) and _match_path(path, x) for x in paths):
+        yield path, value
+
+
   def _send_command(self, command, is_vyatta_op=True, with_err=False):
+    if with_err is True:
+      # stderr is discarded by the persistent shell, use a dedicated channel
+      if is_vyatta_op is True:
+        op = self._CMD_PREFIX + command
+      else:
+        op = command
+
+      output = self._device.exec_command(op)[1:3]
+      return [output[0].read().decode("utf-8"), output[1].read().decode("utf-8")]
+
+    # the persistent shell has sourced the bash completion in open()
     if is_vyatta_op is True:
-      op = self._CMD_PREFIX + command
+      op = self._CMD_OP + command
     else:
       op = command
 
-    if with_err is True:
-      output = self._device.exec_command(op)[1:3]
-      output = [output[0].read(), output[1].read()]
+    marker_id = self._shell_send([op])
+
+    return self._recv_output(command, marker_id)
+
+
+  def _send_commands_batch(self, commands, is_vyatta_op=True):
+    """
+    Run several commands in a single round trip and return their outputs as a list.
+    All commands are written to the shell at once, separated by "__SEP_<i>__" markers,
+    and the combined output is split locally.
+    With the 'parallel_commands' optional argument, _send_many is used instead.
+    """
+    if self._parallel_commands:
+      return self._send_many(commands, is_vyatta_op)
+
+    if is_vyatta_op is True:
+      ops = [self._CMD_OP + x for x in commands]
     else:
-      output = self._device.exec_command(op)[1].read()
+      ops = list(commands)
 
-    return output 
+    marker_id = self._shell_send(ops)
+
+    return _SEP_MARKER_RE.split(self._recv_output(", ".join(commands), marker_id))
+
+
+  def _send_many(self, commands, is_vyatta_op=True):
+    """
+    Run each command on its own channel of the SSH session concurrently,
+    and return their outputs as a list.
+    """
+    if is_vyatta_op is True:
+      ops = [self._CMD_PREFIX + x for x in commands]
+    else:
+      ops = list(commands)
+
+    if self._thread_pool is None:
+      self._thread_pool = ThreadPoolExecutor(max_workers=4)
+
+    return list(self._thread_pool.map(self._exec_command, ops))
+
+
+  def _exec_command(self, op):
+    return self._device.exec_command(op)[1].read().decode("utf-8")
+
+
+  def _send_command_lines(self, command, is_vyatta_op=True):
+    """
+    Run 'command' like _send_command, but yield its output line by line while it is
+    being received, so that parsing can start before the whole output has arrived.
+    """
+    if is_vyatta_op is True:
+      op = self._CMD_OP + command
+    else:
+      op = command
+
+    marker_id = self._shell_send([op])
+
+    chunks = self._recv_chunks(command, marker_id)
+    try:
+      rest = ""
+      for chunk in chunks:
+        lines = (rest + chunk).split("\n")
+        rest = lines.pop()
+        for line in lines:
+          yield line
+      if rest:
+        yield rest
+    finally:
+      # if the caller stops early, drain the output so that it is not read by the next command
+      for chunk in chunks:
+        pass
+
+
+  def _shell_send(self, ops):
+    """
+    Write 'ops' to the persistent shell, separated by "__SEP_<i>__" markers and followed
+    by an end marker with a new id. Return the marker id, which _recv_chunks waits for.
+    """
+    if self._shell is None:
+      raise ConnectionException("SSH shell channel is not open")
+
+    # The shell reads its commands from stdin: each op is quoted and run by eval with
+    # stdin from /dev/null, so that neither a command reading stdin nor an unbalanced
+    # quote (e.g. in a commit_config line) can swallow the markers that follow it
+    marker_id = str(next(_MARKER_IDS))
+    script = "".join("eval %s </dev/null\necho __SEP_%d__\n" % (shlex.quote(x), i)
+                     for i, x in enumerate(ops[:-1]))
+    script += "eval %s </dev/null\necho __END_%s__$?__\n" % (shlex.quote(ops[-1]), marker_id)
+    try:
+      self._shell.sendall(script)
+    except BaseException:
+      self._reset_shell()
+      raise
+
+    self._pending_marker = marker_id
+    return marker_id
+
+
+  def _reset_shell(self):
+    # The shell may still hold (part of) the output of a command, which would be read
+    # as the output of the next one: drop it, commands fail until the driver is reopened
+    if self._shell is not None:
+      self._shell.close()
+      self._shell = None
+    self._pending_marker = None
+
+
+  def _recv_output(self, command, marker_id):
+    return "".join(self._recv_chunks(command, marker_id))
+
+
+  def _recv_chunks(self, command, marker_id):
+    # a multi-byte character may be split across two reads
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    buf = ""
+    try:
+      while True:
+        data = self._shell.recv(65536)
+        if not data:
+          raise ConnectionException("SSH channel closed while running '%s'" % command)
+        buf += decoder.decode(data)
+
+        match = _END_MARKER_RE.search(buf)
+        # discard what is left over from an earlier command
+        while match is not None and match.group(1) != marker_id:
+          buf = buf[match.end():]
+          match = _END_MARKER_RE.search(buf)
+
+        if match is not None:
+          break
+        # hold back the tail, it may be the beginning of the marker
+        if len(buf) > 64:
+          yield buf[:-64]
+          buf = buf[-64:]
+    except BaseException:
+      # also on GeneratorExit: the rest of the output has not been read
+      self._reset_shell()
+      raise
+
+    self._pending_marker = None
+    yield buf[:match.start()]
+
+
+  @staticmethod
+  def _split_blocks(lines):
+    """Group 'lines' into blocks, each starting at a non-indented line."""
+    block = list()
+    for line in lines:
+      if block and line[:1] not in ("", " ", "\t"):
+        yield "\n".join(block) + "\n"
+        block = list()
+      block.append(line)
+    if block:
+      yield "\n".join(block) + "\n"
 
 
   def parse_uptime(self, uptime_str):
@@ -582,86 +989,60 @@ class VyOSDriver(NetworkDriver):
 
   def get_interfaces_ip(self):
     output = self._send_command("show interfaces")
-    output = output.split("\n")
-
-    # delete the header line and the interfaces which has no ip address
-    ifaces = [x for x in output[3:-1] if "-" not in x]
 
     ifaces_ip = dict()
+    iface_name = None
 
-    for iface in ifaces:
-      iface = iface.split()
-    
-      if len(iface) != 1:
-
-        iface_name = iface[0]
+    # The header lines and the interfaces without address ("-") do not match
+    for match in _RE_IFACE_IP.finditer(output):
+      if match.group(1) is not None:
+        iface_name = match.group(1)
+      elif iface_name is None:
+        # continuation row before any interface name
+        continue
 
-        # Delete the "Interface" column
-        iface = iface[1:-1]
-        # Key initialization
-        ifaces_ip[iface_name] = dict()
+      ip_addr, mask = match.group(2, 3)
+      ip_ver = self._get_ip_version(ip_addr)
 
-      ip_addr, mask = iface[0].split("/")
-      ip_ver = self._get_ip_version(ip_addr) 
-
-      # Key initialization
-      if ip_ver not in ifaces_ip[iface_name]:
-        ifaces_ip[iface_name][ip_ver] = dict()
-
-      ifaces_ip[iface_name][ip_ver][ip_addr] = { "prefix_length": mask }
+      ifaces_ip.setdefault(iface_name, {}).setdefault(ip_ver, {})[ip_addr] = {"prefix_length": mask}
 
     return ifaces_ip
 
 
   @staticmethod
   def _get_ip_version(ip_address):
-    if ":" in ip_address:
-      return "ipv6"
-    elif "." in ip_address:
-      return "ipv4"
+    # "show interfaces" only lists IPv4 and IPv6 addresses
+    return "ipv6" if ":" in ip_address else "ipv4"
   
   
   def get_users(self):
-    output = self._send_command("show configuration commands").split("\n")
-
-    user_conf = [x.split() for x in output if "login" in x]
-
-    # Collect all users' name 
-    user_name = list(set([x[4] for x in user_conf]))
+    output = self._send_command("show configuration commands").splitlines()
 
-    user_auth = dict()
+    # "set system login user <name> ..." lines only, "login" may also appear in
+    # other lines (e.g. "set system login banner pre-login ...")
+    user_conf = [x for x in (line.split() for line in output) if x[1:4] == ["system", "login", "user"]]
 
-    for user in user_name:
+    user_auth = defaultdict(lambda: {"level": 0, "password": None, "sshkeys": []})
 
-      sshkeys = list()
+    for line in user_conf:
+      user = user_auth[line[4]]
 
-      # extract the configuration which relates to 'user'
-      for line in [x for x in user_conf if user in x]:
+      # "set system login user alice authentication encrypted-password 'abc'"
+      if line[6] == "encrypted-password":
+        user["password"] = line[7].strip("'")
 
-        # "set system login user alice authentication encrypted-password 'abc'"
-        if line[6] == "encrypted-password":
-          password = line[7].strip("'")
+      # set system login user alice level 'admin'
+      elif line[5] == "level":
+        if line[6].strip("'") == "admin":
+          user["level"] = 15
+        else:
+          user["level"] = 0
 
-        # set system login user alice level 'admin'
-        elif line[5] == "level":
-          if line[6].strip("'") == "admin":
-            level = 15
-          else:
-            level = 0
-
-        # "set system login user alice authentication public-keys alice@example.com key 'ABC'"
-        elif len(line) == 10 and line[8] == "key":
-          sshkeys.append(line[9].strip("'"))
-
-      user_auth.update({
-        user: {
-          "level": level,
-          "password": password,
-          "sshkeys": sshkeys
-        }
-      })
+      # "set system login user alice authentication public-keys alice@example.com key 'ABC'"
+      elif len(line) == 10 and line[8] == "key":
+        user["sshkeys"].append(line[9].strip("'"))
 
-    return user_auth
+    return dict(user_auth)
 
 
   def ping(self, destination, source="", ttl=255, timeout=2, size=100, count=5):
@@ -679,12 +1060,12 @@ class VyOSDriver(NetworkDriver):
 
     output, err = self._send_command(command, with_err=True)
 
-    if err is not "":
+    if err:
       ping_result["error"] = err
     else:
       # 'packet_info' example: 
       # ['5', 'packets', 'transmitted,' '5', 'received,' '0%', 'packet', 'loss,', 'time', '3997ms']
-      packet_info = output.split("\n")[-3]
+      packet_info = output.splitlines()[-2]
       packet_info = [x.strip() for x in packet_info.split()]
 
       sent = int(packet_info[0])
@@ -693,8 +1074,8 @@ class VyOSDriver(NetworkDriver):
 
       # 'rtt_info' example:
       # ["0.307/0.396/0.480/0.061"]
-      rtt_info = output.split("\n")[-2]
-      match = re.search("([\d\.]+)/([\d\.]+)/([\d\.]+)/[\d\.]+", rtt_info)
+      rtt_info = output.splitlines()[-1]
+      match = _RE_PING_RTT.search(rtt_info)
       
       if match is not None:
         rtt_min = float(match.group(1))
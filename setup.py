@@ -1,14 +1,12 @@
 """setup.py file."""
 
-import uuid
-
 from setuptools import setup, find_packages
-from pip.req import parse_requirements
 
 __author__ = 'Shota Muto <dos9954@gmail.com>'
 
-install_reqs = parse_requirements('requirements.txt', session=uuid.uuid1())
-reqs = [str(ir.req) for ir in install_reqs]
+# pip.req is not a public API and is gone from current pip, read the file directly
+with open('requirements.txt') as f:
+    reqs = [line.strip() for line in f if line.strip() and not line.startswith('#')]
 
 setup(
     name="napalm-vyos",
@@ -20,11 +18,11 @@ setup(
     classifiers=[
         'Topic :: Utilities',
          'Programming Language :: Python',
-         'Programming Language :: Python :: 2',
-         'Programming Language :: Python :: 2.7',
+         'Programming Language :: Python :: 3',
          'Operating System :: POSIX :: Linux',
          'Operating System :: MacOS',
     ],
     include_package_data=True,
+    python_requires='>=3',
     install_requires=reqs,
 )
@@ -0,0 +1,375 @@
+# Copyright 2016 Dravetech AB. All rights reserved.
+#
+# The contents of this file are licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""Tests of the output parsers, against mocked device output."""
+
+import re
+import socket
+import unittest
+from unittest import mock
+
+from napalm_base.exceptions import ConnectionException
+
+from napalm_vyos import vyos
+from napalm_vyos.vyos import VyOSDriver
+
+
+SHOW_CONFIGURATION = """interfaces {
+    ethernet eth0 {
+        address 192.168.1.1/24
+        address 10.0.0.1/24
+        description "Management port"
+        hw-id 00:50:56:86:8c:26
+        vif 10 {
+            description "VLAN 10"
+        }
+    }
+    ethernet eth1 {
+        hw-id 00:50:56:86:8c:27
+    }
+    loopback lo {
+    }
+}
+service {
+    snmp {
+        community public {
+            authorization ro
+        }
+    }
+}
+system {
+    /* comment */
+    host-name vyos
+    login {
+        user vyos {
+            authentication {
+                encrypted-password ****
+            }
+        }
+    }
+    domain-name example.com
+}
+"""
+
+SHOW_INTERFACES = """Interface        IP Address                        S/L  Description
+---------        ----------                        ---  -----------
+eth0             192.168.1.1/24                    u/u  Management port
+                 10.0.0.1/24
+eth1             -                                 A/D
+lo               127.0.0.1/8                       u/u
+                 ::1/128
+"""
+
+SHOW_INTERFACES_DETAIL = ("eth0: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500 qdisc pfifo_fast state UP group default "
+                          "qlen 1000\n"
+                          """    link/ether 00:50:56:86:8c:26 brd ff:ff:ff:ff:ff:ff
+    inet 192.168.1.1/24 brd 192.168.1.255 scope global eth0
+       valid_lft forever preferred_lft forever
+    Description: Management port
+
+    RX:  bytes    packets     errors    dropped    overrun      mcast
+      35960043     464584          0        221          0        407
+    TX:  bytes    packets     errors    dropped    carrier collisions
+      32776498     279273          0          0          0          0
+
+br0: <BROADCAST,MULTICAST> mtu 1500 qdisc noop state DOWN group default
+    link/ether 00:00:00:00:00:00 brd ff:ff:ff:ff:ff:ff
+
+lo: <LOOPBACK,UP,LOWER_UP> mtu 65536 qdisc noqueue state UNKNOWN group default
+    link/loopback 00:00:00:00:00:00 brd 00:00:00:00:00:00
+    inet 127.0.0.1/8 scope host lo
+       valid_lft forever preferred_lft forever
+
+    RX:  bytes    packets     errors    dropped    overrun      mcast
+          1000         10          1          2          0          3
+    TX:  bytes    packets     errors    dropped    carrier collisions
+          2000         20          4          5          0          0
+""")
+
+
+class FakeShell:
+    """Test double of the persistent shell channel, replies to each command with canned output."""
+
+    def __init__(self, outputs, chunk_size=7):
+        self.outputs = list(outputs)
+        self.chunk_size = chunk_size
+        self.buffer = b""
+        self.scripts = []
+        self.closed = False
+
+    def sendall(self, script):
+        """Queue the next outputs, separated and terminated like the device would."""
+        self.scripts.append(script)
+        separators = re.findall(r"echo (__SEP_\d+__)", script)
+        marker_id = re.search(r"echo __END_(\d+)__", script).group(1)
+        output = "".join(self.outputs.pop(0) + sep + "\n" for sep in separators)
+        output += self.outputs.pop(0) + "__END_%s__0__\n" % marker_id
+        self.buffer += output.encode("utf-8")
+
+    def recv(self, size):
+        """Return the queued output in small chunks, to split lines and markers across reads."""
+        if not self.buffer:
+            # like a channel with a timeout, on which the device does not answer
+            raise socket.timeout()
+        data, self.buffer = self.buffer[:self.chunk_size], self.buffer[self.chunk_size:]
+        return data
+
+    def close(self):
+        """Close the channel."""
+        self.closed = True
+
+
+class FakeClient:
+    """Test double of the SSH client, counts the calls to close()."""
+
+    def __init__(self):
+        self.close_count = 0
+
+    def close(self):
+        """Close the connection."""
+        self.close_count += 1
+
+
+def fake_driver(*outputs):
+    """Return a driver whose commands return 'outputs' in order."""
+    device = VyOSDriver("127.0.0.1", "vagrant", "vagrant")
+    device._shell = FakeShell(outputs)
+    return device
+
+
+class TestShell(unittest.TestCase):
+    """Tests of the end markers of the persistent shell."""
+
+    def test_commands_do_not_read_stdin(self):
+        """Each command is quoted and run with stdin from /dev/null, before its marker."""
+        device = fake_driver("output\n")
+        device._send_command("show 'version")
+
+        self.assertRegex(device._shell.scripts[0],
+                         r"^eval 'eval _vyatta_op_run show '\"'\"'version' </dev/null\n"
+                         r"echo __END_\d+__\$\?__\n$")
+
+    def test_stale_marker_discarded(self):
+        """Output left over from an earlier command is not returned by the next one."""
+        device = fake_driver("output\n")
+        device._shell.buffer = b"stale output\n__END_0__0__\n"
+
+        self.assertEqual(device._send_command("show version"), "output\n")
+        self.assertIsNone(device._pending_marker)
+
+    def test_timeout_resets_shell(self):
+        """On a timeout the shell is closed, and later commands fail instead of desynchronizing."""
+        device = fake_driver()
+        shell = device._shell
+        shell.sendall = shell.scripts.append
+
+        self.assertRaises(socket.timeout, device._send_command, "show version")
+        self.assertTrue(shell.closed)
+        self.assertIsNone(device._shell)
+        self.assertRaises(ConnectionException, device._send_command, "show version")
+
+
+class TestClose(unittest.TestCase):
+    """Tests of close()."""
+
+    def test_close_twice(self):
+        """The second close() does nothing."""
+        device = fake_driver()
+        client = device._device = FakeClient()
+
+        device.close()
+        device.close()
+        self.assertEqual(client.close_count, 1)
+        self.assertIsNone(device._shell)
+
+    def test_close_twice_pooled(self):
+        """The second close() does nothing once the connection is back in the pool."""
+        device = fake_driver()
+        client = device._device = FakeClient()
+
+        with mock.patch.object(vyos, "CONNECTION_POOL_ENABLED", True):
+            device.close()
+            device.close()
+        self.assertEqual(client.close_count, 0)
+        self.assertIn(device._pool_key(), vyos._POOL)
+
+        vyos._pool_clear()
+        self.assertEqual(client.close_count, 1)
+
+
+class TestConfigGet(unittest.TestCase):
+    """Tests of the lazy "show configuration" accessor."""
+
+    def test_tag_nodes_and_quoted_values(self):
+        """Tag nodes are yielded with None, leaves with their value without quotes."""
+        result = list(VyOSDriver._config_get(SHOW_CONFIGURATION, ("interfaces", "*", "*")))
+
+        self.assertEqual(result, [
+            (("interfaces", "ethernet", "eth0"), None),
+            (("interfaces", "ethernet", "eth0", "address"), "192.168.1.1/24"),
+            (("interfaces", "ethernet", "eth0", "address"), "10.0.0.1/24"),
+            (("interfaces", "ethernet", "eth0", "description"), "Management port"),
+            (("interfaces", "ethernet", "eth0", "hw-id"), "00:50:56:86:8c:26"),
+            (("interfaces", "ethernet", "eth0", "vif", "10"), None),
+            (("interfaces", "ethernet", "eth0", "vif", "10", "description"), "VLAN 10"),
+            (("interfaces", "ethernet", "eth1"), None),
+            (("interfaces", "ethernet", "eth1", "hw-id"), "00:50:56:86:8c:27"),
+            (("interfaces", "loopback", "lo"), None),
+        ])
+
+    def test_leaves_and_skipped_subtrees(self):
+        """Only the requested leaves are yielded, the rest of the tree is skipped."""
+        result = list(VyOSDriver._config_get(SHOW_CONFIGURATION, ("system", "host-name"),
+                                             ("system", "domain-name")))
+
+        self.assertEqual(result, [
+            (("system", "host-name"), "vyos"),
+            (("system", "domain-name"), "example.com"),
+        ])
+
+    def test_nested_path(self):
+        """Paths can select nodes below tag nodes."""
+        result = list(VyOSDriver._config_get(SHOW_CONFIGURATION, ("service", "snmp", "community")))
+
+        self.assertEqual(result, [
+            (("service", "snmp", "community", "public"), None),
+            (("service", "snmp", "community", "public", "authorization"), "ro"),
+        ])
+
+    def test_get_interfaces(self):
+        """Interfaces come from the configuration, their state from "show interfaces"."""
+        device = fake_driver(SHOW_INTERFACES, SHOW_CONFIGURATION)
+
+        self.assertEqual(device.get_interfaces(), {
+            "eth0": {
+                "is_up": True,
+                "is_enabled": True,
+                "description": "Management port",
+                "last_flapped": -1,
+                "speed": None,
+                "mac_address": "00:50:56:86:8c:26"
+            },
+            "eth1": {
+                "is_up": False,
+                "is_enabled": False,
+                "description": None,
+                "last_flapped": -1,
+                "speed": None,
+                "mac_address": "00:50:56:86:8c:27"
+            },
+            "lo": {
+                "is_up": True,
+                "is_enabled": True,
+                "description": None,
+                "last_flapped": -1,
+                "speed": None,
+                "mac_address": None
+            },
+        })
+
+
+class TestInterfacesCounters(unittest.TestCase):
+    """Tests of get_interfaces_counters."""
+
+    def test_counters(self):
+        """Each interface gets its own RX/TX rows, interfaces without counters are skipped."""
+        device = fake_driver(SHOW_INTERFACES_DETAIL)
+
+        self.assertEqual(device.get_interfaces_counters(), {
+            "eth0": {
+                "tx_errors": 0,
+                "tx_discards": 0,
+                "tx_octets": 32776498,
+                "tx_unicast_packets": None,
+                "tx_multicast_packets": None,
+                "tx_broadcast_packets": None,
+                "rx_errors": 0,
+                "rx_discards": 221,
+                "rx_octets": 35960043,
+                "rx_unicast_packets": None,
+                "rx_multicast_packets": 407,
+                "rx_broadcast_packets": None
+            },
+            "lo": {
+                "tx_errors": 4,
+                "tx_discards": 5,
+                "tx_octets": 2000,
+                "tx_unicast_packets": None,
+                "tx_multicast_packets": None,
+                "tx_broadcast_packets": None,
+                "rx_errors": 1,
+                "rx_discards": 2,
+                "rx_octets": 1000,
+                "rx_unicast_packets": None,
+                "rx_multicast_packets": 3,
+                "rx_broadcast_packets": None
+            },
+        })
+
+    def test_long_block_without_counters(self):
+        """A long block without RX/TX rows is skipped without backtracking for ages."""
+        tunnel = "tun0: <POINTOPOINT,NOARP> mtu 1476 qdisc noop state DOWN group default\n"
+        tunnel += "    link/gre 10.0.0.1 peer 10.0.0.2\n"
+        tunnel += ("    inet 10.1.0.1/30 scope global tun0\n"
+                   "       valid_lft forever preferred_lft forever\n") * 10
+        device = fake_driver(tunnel + "\n" + SHOW_INTERFACES_DETAIL)
+
+        self.assertEqual(sorted(device.get_interfaces_counters()), ["eth0", "lo"])
+
+    def test_counters_are_int(self):
+        """Counter values are returned as integers, not strings."""
+        device = fake_driver(SHOW_INTERFACES_DETAIL)
+
+        for counters in device.get_interfaces_counters().values():
+            for key, value in counters.items():
+                if value is not None:
+                    self.assertIsInstance(value, int, key)
+
+
+class TestInterfacesIp(unittest.TestCase):
+    """Tests of get_interfaces_ip."""
+
+    def test_continuation_rows(self):
+        """Continuation rows belong to the last named interface."""
+        device = fake_driver(SHOW_INTERFACES)
+
+        self.assertEqual(device.get_interfaces_ip(), {
+            "eth0": {"ipv4": {"192.168.1.1": {"prefix_length": "24"}, "10.0.0.1": {"prefix_length": "24"}}},
+            "lo": {"ipv4": {"127.0.0.1": {"prefix_length": "8"}}, "ipv6": {"::1": {"prefix_length": "128"}}},
+        })
+
+    def test_leading_continuation_row(self):
+        """A continuation row before any named row is skipped."""
+        device = fake_driver("                 10.0.0.1/24\n" + SHOW_INTERFACES.split("\n", 2)[2])
+
+        self.assertEqual(sorted(device.get_interfaces_ip()), ["eth0", "lo"])
+
+
+class TestBgpTimeConversion(unittest.TestCase):
+    """Tests of the BGP Up/Down column conversion."""
+
+    def test_formats(self):
+        """Time of day, unit pairs and "never" are converted to seconds."""
+        self.assertEqual(VyOSDriver._bgp_time_conversion("01:02:03"), 3723)
+        self.assertEqual(VyOSDriver._bgp_time_conversion("4d23h40m"), 430800)
+        self.assertEqual(VyOSDriver._bgp_time_conversion("5w1d"), 3110400)
+        self.assertEqual(VyOSDriver._bgp_time_conversion("never"), -1)
+
+    def test_unknown_format(self):
+        """An uptime which does not parse raises ValueError instead of returning 0."""
+        self.assertRaises(ValueError, VyOSDriver._bgp_time_conversion, "abc")
+
+
+if __name__ == "__main__":
+    unittest.main()